@@ -1,4 +1,5 @@
 import datetime
+import itertools
 import logging
 import re
 import requests
@@ -6,9 +7,10 @@ import string
 import uuid
 from collections import OrderedDict
 from decimal import Decimal
-from typing import Any, Dict
+from typing import Any, Dict, List, NamedTuple
 
 from django import forms
+from django.db import transaction
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.translation import gettext_lazy as _
@@ -20,16 +22,40 @@ from pretix.multidomain.urlreverse import eventreverse, build_absolute_uri
 
 logger = logging.getLogger('pretix_promptpay_scb')
 
+# Lower bound of the qr_lifetime setting, in minutes.
+MIN_QR_LIFETIME = 1
+
+# Connect and read timeouts for SCB requests, in seconds. A hanging request
+# counts as a failure of the credential set, like any network error.
+SCB_API_TIMEOUT = (5, 15)
+
+# Seconds a credential set is skipped for after a failed request.
+CREDENTIAL_UNHEALTHY_TIMEOUT = 60
+
+# Drives the weighted round-robin between credential sets. Per process, which
+# evens out over many workers.
+_credential_counter = itertools.count()
+
 class ScbPartnerApi():
     """
     Provide convenience wrapper around SCB partner API convention.
     """
 
     class BussinessError(RuntimeError):
-        def __init__(self, code, description):
+        def __init__(self, code, description, http_status=200):
             super().__init__('Bussiness error %d: %s' % (code, description))
             self.code = code
             self.description = description
+            self.http_status = http_status
+
+        @property
+        def is_request_error(self):
+            """
+                Whether SCB rejected the request itself (e.g. the amount or a
+                reference), as opposed to the credentials, a rate limit or
+                an error on SCB's side. Retrying such a request won't help.
+            """
+            return self.http_status < 500 and self.http_status not in (401, 403, 429)
 
     access_token: Dict[str, Any]
 
@@ -57,13 +83,26 @@ class ScbPartnerApi():
         if not skip_authz:
             headers['authorization'] = self.get_authz_header()
 
-        response = requests.post(url=url, json=json, headers=headers).json()
+        http_response = requests.post(url=url, json=json, headers=headers, timeout=SCB_API_TIMEOUT)
+        try:
+            response = http_response.json()
+        except ValueError:
+            # e.g. an error page from a gateway in front of the API.
+            http_response.raise_for_status()
+            raise
+
         status = response['status']
         if status['code'] != 1000:
-            raise ScbPartnerApi.BussinessError(status['code'], status['description'])
+            raise ScbPartnerApi.BussinessError(status['code'], status['description'],
+                                               http_status=http_response.status_code)
 
         return response['data']
 
+    @property
+    def access_token_cache_key(self):
+        # Each application has its own token.
+        return 'scb_access_token_%s' % self.app_key
+
     def is_access_token_expired(self):
         now = timezone.now()
         expiresAt = datetime.datetime.fromtimestamp(self.access_token['expiresAt'])
@@ -72,7 +111,7 @@ class ScbPartnerApi():
 
     def get_authz_header(self):
         if self.access_token is None:
-            self.access_token = self.cache.get('scb_access_token')
+            self.access_token = self.cache.get(self.access_token_cache_key)
 
         if self.access_token is None or self.is_access_token_expired():
             self.access_token = self.post(
@@ -83,7 +122,7 @@ class ScbPartnerApi():
                 },
                 skip_authz=True
             )
-            self.cache.set('scb_access_token', self.access_token, timeout=self.access_token['expiresIn'])
+            self.cache.set(self.access_token_cache_key, self.access_token, timeout=self.access_token['expiresIn'])
 
         return '%s %s' % (self.access_token['tokenType'], self.access_token['accessToken'])
 
@@ -99,6 +138,17 @@ class ScbPartnerApi():
         })
 
 
+class ScbCredentialSet(NamedTuple):
+    app_key: str
+    app_secret: str
+    pp_id: str
+    weight: int = 1
+
+    @property
+    def unhealthy_cache_key(self):
+        return 'scb_unhealthy_%s' % self.app_key
+
+
 class PromptPayScbPaymentProvider(BasePaymentProvider):
     identifier = 'promptpay_scb'
     verbose_name = 'Thai PromptPay QR via SCB API'
@@ -132,6 +182,28 @@ class PromptPayScbPaymentProvider(BasePaymentProvider):
                     label=_('Biller ID'),
                     required=True,
                 )),
+                ('extra_credentials', forms.CharField(
+                    widget=forms.Textarea,
+                    label=_('Additional applications'),
+                    help_text=_('One per line: application key, application secret, biller ID and optionally '
+                                'a weight, separated by spaces. QR codes are created using all applications in '
+                                'turn, to go beyond the rate limit of a single one. The application above has '
+                                'weight 1. Each application needs the same callback configured.'),
+                    required=False,
+                )),
+                ('qr_create_async', forms.BooleanField(
+                    label=_('Create QR code in the background'),
+                    help_text=_('Show the payment page right away and load the QR code once SCB returns it. '
+                                'Requires a running task worker.'),
+                    required=False,
+                )),
+                ('qr_lifetime', forms.IntegerField(
+                    label=_('QR code lifetime'),
+                    help_text=_('In minutes. Unpaid QR payments older than this are canceled automatically. '
+                                'Payments arriving later are still accepted. Leave empty to never cancel them.'),
+                    required=False,
+                    min_value=MIN_QR_LIFETIME,
+                )),
                 ('ref3_prefix', forms.RegexField(
                     widget=forms.TextInput,
                     label=_('Reference 3 prefix'),
@@ -147,8 +219,72 @@ class PromptPayScbPaymentProvider(BasePaymentProvider):
         api_url = re.sub(r'/$', '', cleaned_data.get('payment_promptpay_scb_api_url'))
         cleaned_data['payment_promptpay_scb_api_url'] = api_url
 
+        extra_credentials = cleaned_data.get('payment_promptpay_scb_extra_credentials')
+        if extra_credentials:
+            try:
+                self.parse_credential_sets(extra_credentials)
+            except ValueError as e:
+                raise forms.ValidationError({ 'payment_promptpay_scb_extra_credentials': str(e) })
+
         return cleaned_data
 
+    @staticmethod
+    def parse_credential_sets(text: str) -> List[ScbCredentialSet]:
+        credential_sets = []
+        for lineno, line in enumerate(text.splitlines(), start=1):
+            fields = line.split()
+            if not fields:
+                continue
+
+            if len(fields) not in (3, 4):
+                raise ValueError(_('Line {lineno}: expected 3 or 4 values.').format(lineno=lineno))
+
+            weight = 1
+            if len(fields) == 4:
+                try:
+                    weight = int(fields[3])
+                except ValueError:
+                    weight = 0
+                if weight < 1:
+                    raise ValueError(_('Line {lineno}: weight must be a positive number.').format(lineno=lineno))
+
+            credential_sets.append(ScbCredentialSet(
+                app_key=fields[0], app_secret=fields[1], pp_id=fields[2], weight=weight))
+
+        return credential_sets
+
+    def get_credential_sets(self) -> List[ScbCredentialSet]:
+        credential_sets = [ScbCredentialSet(
+            app_key=self.settings.application_key,
+            app_secret=self.settings.application_secret,
+            pp_id=self.settings.pp_id,
+        )]
+        if self.settings.extra_credentials:
+            credential_sets += self.parse_credential_sets(self.settings.extra_credentials)
+
+        return credential_sets
+
+    def get_biller_ids(self):
+        """
+            All biller IDs a payment can be made to. Also called from the
+            payment callback view.
+        """
+        return { c.pp_id for c in self.get_credential_sets() }
+
+    def select_credential_sets(self) -> List[ScbCredentialSet]:
+        """
+            Order credential sets for the next request: the next one in
+            weighted round-robin first, then the others to fail over to.
+            Sets which failed recently are left out, unless all of them did.
+        """
+        credential_sets = self.get_credential_sets()
+        unhealthy = self.event.cache.get_many([c.unhealthy_cache_key for c in credential_sets])
+        healthy = [c for c in credential_sets if c.unhealthy_cache_key not in unhealthy] or credential_sets
+
+        slots = [c for c in healthy for _ in range(c.weight)]
+        start = healthy.index(slots[next(_credential_counter) % len(slots)])
+        return healthy[start:] + healthy[:start]
+
     def get_callback_secret(self):
         secret = self.settings.callback_secret
         if secret is None:
@@ -197,39 +333,77 @@ class PromptPayScbPaymentProvider(BasePaymentProvider):
         # Shorten to the first 20 chars.
         return slugRef[:20]
 
-    def execute_payment(self, request, payment):
-        api = ScbPartnerApi(
+    def get_api(self, credential_set: ScbCredentialSet):
+        return ScbPartnerApi(
             base_url=self.settings.api_url,
-            app_key=self.settings.application_key,
-            app_secret=self.settings.application_secret,
+            app_key=credential_set.app_key,
+            app_secret=credential_set.app_secret,
             cache=self.event.cache,
         )
 
+    def create_qr_code(self, payment):
+        """
+            Ask SCB for the QR image of this payment. Returns the base64-encoded
+            image; raises ScbPartnerApi.BussinessError or
+            requests.RequestException on failure. On network, credential,
+            rate limit or server errors, the next credential set is tried.
+            Also called from the background task.
+        """
+
         # All references are [A-Z0-9]{1,20}, thus some transformation is
         # needed before putting things into slug.
-        
+
         ref1 = self.get_event_ref1()
         ref2 = payment.order.code
         # Have nothing to append to ref3 yet.
         ref3 = self.settings.ref3_prefix
 
-        try:
-            qr_response = api.qrcode_create_biller(
-                amount=payment.amount,
-                ppId=self.settings.pp_id,
-                ref1=ref1,
-                ref2=ref2,
-                ref3=ref3,
-            )
-        except ScbPartnerApi.BussinessError as e:
-            logger.exception('Error on creating QR code: ' + str(e))
-            raise PaymentException(_('เกิดข้อผิดพลาดในการสร้าง QR code')) from e
-
-        # Keep only the QR image, for displaying in our custom view.
-        qr_image = qr_response['qrImage']
-        payment.info_data = { 'qr_image': qr_image }
-        payment.state = OrderPayment.PAYMENT_STATE_PENDING
-        payment.save()
+        credential_sets = self.select_credential_sets()
+        for i, credential_set in enumerate(credential_sets):
+            try:
+                qr_response = self.get_api(credential_set).qrcode_create_biller(
+                    amount=payment.amount,
+                    ppId=credential_set.pp_id,
+                    ref1=ref1,
+                    ref2=ref2,
+                    ref3=ref3,
+                )
+            except (ScbPartnerApi.BussinessError, requests.RequestException) as e:
+                if isinstance(e, ScbPartnerApi.BussinessError) and e.is_request_error:
+                    # Other credential sets would reject it just the same.
+                    raise
+
+                logger.warning('Error on creating QR code with application %s: %s', credential_set.app_key, e)
+                self.event.cache.set(credential_set.unhealthy_cache_key, True,
+                                     timeout=CREDENTIAL_UNHEALTHY_TIMEOUT)
+                if i == len(credential_sets) - 1:
+                    raise
+                continue
+
+            # Keep only the QR image, for displaying in our custom view.
+            return qr_response['qrImage']
+
+    def execute_payment(self, request, payment):
+        if self.settings.get('qr_create_async', as_type=bool, default=False):
+            from .tasks import create_qr_code
+
+            # The QR code is filled in by the task; ShowQrView polls for it.
+            payment.info_data = { 'qr_pending': True }
+            payment.state = OrderPayment.PAYMENT_STATE_PENDING
+            payment.save()
+
+            transaction.on_commit(lambda: create_qr_code.apply_async(
+                kwargs={ 'event': self.event.pk, 'payment': payment.pk }))
+        else:
+            try:
+                qr_image = self.create_qr_code(payment)
+            except (ScbPartnerApi.BussinessError, requests.RequestException) as e:
+                logger.exception('Error on creating QR code: ' + str(e))
+                raise PaymentException(_('เกิดข้อผิดพลาดในการสร้าง QR code')) from e
+
+            payment.info_data = { 'qr_image': qr_image }
+            payment.state = OrderPayment.PAYMENT_STATE_PENDING
+            payment.save()
 
         return eventreverse(
             obj=self.event,
@@ -1,8 +1,32 @@
+import datetime
+
 from django.dispatch import receiver
+from django.utils import timezone
+from django_scopes import scopes_disabled
 
-from pretix.base.signals import register_payment_providers
+from pretix.base.models import Event, OrderPayment
+from pretix.base.signals import periodic_task, register_payment_providers
+from pretix.helpers.periodic import minimum_interval
 
 @receiver(register_payment_providers, dispatch_uid="payment_promptpay_scb")
 def register_payment_provider(sender, **kwargs):
     from .payment import PromptPayScbPaymentProvider
     return PromptPayScbPaymentProvider
+
+@receiver(periodic_task, dispatch_uid="payment_promptpay_scb_expire_payments")
+@scopes_disabled()
+@minimum_interval(minutes_after_success=5)
+def expire_payments(sender, **kwargs):
+    from .payment import MIN_QR_LIFETIME
+    from .tasks import expire_event_payments
+
+    # Only visit events having payments which may be expired under any
+    # lifetime setting, instead of every event which ever used the plugin.
+    event_ids = OrderPayment.objects.filter(
+        provider='promptpay_scb',
+        state__in=(OrderPayment.PAYMENT_STATE_CREATED, OrderPayment.PAYMENT_STATE_PENDING),
+        created__lt=timezone.now() - datetime.timedelta(minutes=MIN_QR_LIFETIME),
+    ).order_by().values('order__event_id').distinct()
+
+    for event in Event.objects.filter(pk__in=event_ids):
+        expire_event_payments(event)
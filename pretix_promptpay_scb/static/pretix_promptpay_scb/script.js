@@ -1,21 +1,50 @@
 (function () {
     const stateUrl = $('#promptpay_scb_container').data('state-url');
-    // Prevent double requests if the request takes a long time.
-    let requestInFlight = false;
+    // Present only when the QR code is still being created in the background.
+    const $pendingQr = $('#promptpay_scb_qr_pending');
+    let waitingForQr = $pendingQr.length > 0;
+    // Let ShowQrView check the payment again if the QR code doesn't show up
+    // in time, e.g. when the background task is lost.
+    const qrDeadline = Date.now() + 60000 /* msec = 60 sec */;
+    // Give up loading the QR code after this many consecutive failed requests.
+    const maxErrors = 5;
+    let errorCount = 0;
 
-    const intervalId = setInterval(async () => {
-        if (requestInFlight)
-            return;
+    function showError() {
+        $('#promptpay_scb_loading').hide();
+        $('#promptpay_scb_error').show();
+    }
 
-        requestInFlight = true;
+    function scheduleNext() {
+        // Poll faster while the QR code is not yet shown.
+        let delay = waitingForQr ? 1000 : 5000 /* msec */;
+        if (!waitingForQr && errorCount > 0) {
+            // Back off while the server can't be reached, but keep trying so
+            // that the page still redirects once paid.
+            delay = Math.min(delay * 2 ** errorCount, 60000);
+        }
+        setTimeout(poll, delay);
+    }
 
+    async function poll() {
         try {
-            const response = await fetch(stateUrl);
+            const response = await fetch(waitingForQr ? stateUrl + '?qr=1' : stateUrl);
+            if (!response.ok)
+                throw new Error('Unexpected status ' + response.status);
             const state = await response.json();
+            errorCount = 0;
 
             if (state.state == 'pending') {
-                requestInFlight = false;
-                return;
+                if (waitingForQr && typeof state.qrDataUrl === 'string') {
+                    $pendingQr.attr('src', state.qrDataUrl).show();
+                    $('#promptpay_scb_loading').hide();
+                    waitingForQr = false;
+                }
+
+                if (waitingForQr && Date.now() > qrDeadline)
+                    window.location.reload();
+                else
+                    scheduleNext();
             } else if (state.state == 'confirmed' &&
                     typeof state.redirectTo === 'string') {
                 window.location.replace(state.redirectTo);
@@ -25,7 +54,14 @@
             }
         } catch (e) {
             console.error(e);
-            requestInFlight = false;
+            errorCount++;
+            if (waitingForQr && errorCount >= maxErrors) {
+                showError();
+            } else {
+                scheduleNext();
+            }
         }
-    }, 5000 /* msec = 5 sec */);
-} ()); // Immediately Invoked Function Expressions
\ No newline at end of file
+    }
+
+    scheduleNext();
+} ()); // Immediately Invoked Function Expressions
@@ -0,0 +1,101 @@
+import datetime
+import json
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from pretix.base.models import Event
+from pretix.base.models.orders import OrderPayment
+from pretix.base.services.tasks import EventTask
+from pretix.celery_app import app
+
+from .payment import ScbPartnerApi
+
+logger = logging.getLogger('pretix_promptpay_scb')
+
+@app.task(base=EventTask, bind=True, max_retries=5, default_retry_delay=2)
+def create_qr_code(self, event: Event, payment: int):
+    """
+        Create the QR code for a payment made with qr_create_async. The result
+        is picked up by the browser through PaymentStateView.
+    """
+    payment = OrderPayment.objects.select_related('order').get(
+        pk=payment, order__event=event)
+
+    if payment.state != OrderPayment.PAYMENT_STATE_PENDING or 'qr_image' in payment.info_data:
+        # Already paid, canceled, or handled by an earlier run.
+        return
+
+    try:
+        qr_image = payment.payment_provider.create_qr_code(payment)
+
+        with transaction.atomic():
+            locked_payment = OrderPayment.objects.select_for_update().get(pk=payment.pk)
+            if locked_payment.state != OrderPayment.PAYMENT_STATE_PENDING:
+                # The payment is confirmed by the callback in the meantime.
+                return
+
+            locked_payment.info_data = { 'qr_image': qr_image }
+            locked_payment.save(update_fields=['info'])
+    except Exception as e:
+        # Anything else (e.g. a malformed response) may still be a glitch,
+        # but the payment must not stay qr_pending forever.
+        request_error = isinstance(e, ScbPartnerApi.BussinessError) and e.is_request_error
+        if self.request.retries < self.max_retries and not request_error:
+            raise self.retry(exc=e)
+
+        logger.exception('Error on creating QR code: ' + str(e))
+        payment.fail(info={ 'qr_error': str(e) })
+
+# Number of payments canceled per transaction by expire_event_payments().
+EXPIRE_BATCH_SIZE = 500
+
+def expire_event_payments(event: Event):
+    """
+        Cancel pending payments whose QR code is older than the qr_lifetime
+        setting. A callback arriving later still confirms the order, as
+        bond_a_payment_to_the_transaction() creates a fresh payment for it.
+    """
+    lifetime = event.settings.get('payment_promptpay_scb_qr_lifetime', as_type=int)
+    if not lifetime:
+        return
+
+    cutoff = timezone.now() - datetime.timedelta(minutes=lifetime)
+    last_pk = 0
+
+    while True:
+        # Page by primary key rather than OFFSET, as the canceled rows drop
+        # out of the result set between batches.
+        batch = list(OrderPayment.objects.filter(
+            order__event=event,
+            provider='promptpay_scb',
+            state__in=(OrderPayment.PAYMENT_STATE_CREATED, OrderPayment.PAYMENT_STATE_PENDING),
+            created__lt=cutoff,
+            pk__gt=last_pk,
+        ).select_related('order').order_by('pk')[:EXPIRE_BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        with transaction.atomic():
+            # Lock the rows and re-check the state, skipping payments confirmed
+            # by a callback since we read the batch.
+            expired_pks = set(OrderPayment.objects.select_for_update().filter(
+                pk__in=[p.pk for p in batch],
+                state__in=(OrderPayment.PAYMENT_STATE_CREATED, OrderPayment.PAYMENT_STATE_PENDING),
+            ).values_list('pk', flat=True))
+            # Also drop the QR image, so that it can no longer be shown.
+            OrderPayment.objects.filter(pk__in=expired_pks).update(
+                state=OrderPayment.PAYMENT_STATE_CANCELED,
+                info=json.dumps({ 'qr_expired': True }))
+
+            for payment in batch:
+                if payment.pk in expired_pks:
+                    payment.order.log_action('pretix.event.order.payment.canceled', {
+                        'local_id': payment.local_id,
+                        'provider': payment.provider,
+                    })
+
+        if len(batch) < EXPIRE_BATCH_SIZE:
+            break
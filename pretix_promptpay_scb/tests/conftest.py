@@ -0,0 +1,38 @@
+import datetime
+import json
+from decimal import Decimal
+
+import pytest
+from django.utils.timezone import now
+from django_scopes import scope
+
+from pretix.base.models import Event, Order, OrderPayment, Organizer
+
+@pytest.fixture
+def env(client):
+    orga = Organizer.objects.create(name='SCB', slug='SCB')
+    with scope(organizer=orga):
+        event = Event.objects.create(
+            organizer=orga, name='SCB PromptPay QR', slug='promptpay',
+            date_from=datetime.datetime(now().year + 1, 12, 26, tzinfo=datetime.timezone.utc),
+            plugins='pretix_promptpay_scb',
+            live=True
+        )
+        order = Order.objects.create(
+            code='FOOBAR', event=event, email='dummy@dummy.test',
+            status=Order.STATUS_PENDING,
+            datetime=now(), expires=now() + datetime.timedelta(days=10),
+            total=Decimal('13.37'),
+        )
+        payment = order.payments.create(
+            amount=order.total,
+            provider='promptpay_scb',
+            state=OrderPayment.PAYMENT_STATE_PENDING,
+            info=json.dumps({
+                # 1x1 GIF.
+                'qr_image': 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mP8/x8AAwMCAO+ip1sAAAAASUVORK5CYII=',
+            }),
+            # What else?
+        )
+
+    return client, orga, event, order, payment
@@ -0,0 +1,185 @@
+import json
+
+import pytest
+import requests
+from django.core.cache import caches
+from django.utils.timezone import now
+from django_scopes import scope
+
+from pretix.base.models import OrderPayment
+from pretix.multidomain.urlreverse import eventreverse
+
+from pretix_promptpay_scb.models import SCBTransaction
+from pretix_promptpay_scb.payment import (
+    SCB_API_TIMEOUT, PromptPayScbPaymentProvider, ScbCredentialSet,
+    ScbPartnerApi,
+)
+
+@pytest.fixture(autouse=True)
+def locmem_cache(settings):
+    # Health tracking lives in the cache, which is a dummy one in tests.
+    settings.CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    caches['default'].clear()
+
+@pytest.fixture
+def env(env):
+    client, orga, event, order, payment = env
+    with scope(organizer=orga):
+        event.settings.set('payment_promptpay_scb_application_key', 'key1')
+        event.settings.set('payment_promptpay_scb_application_secret', 'secret1')
+        event.settings.set('payment_promptpay_scb_pp_id', '111')
+        event.settings.set('payment_promptpay_scb_extra_credentials', 'key2 secret2 222 2\n\nkey3 secret3 333\n')
+        event.settings.set('payment_promptpay_scb__enabled', True)
+        event.settings.set('payment_promptpay_scb_callback_secret', 'secret')
+
+    return env
+
+@pytest.fixture
+def provider(env):
+    client, orga, event, order, payment = env
+    with scope(organizer=orga):
+        yield PromptPayScbPaymentProvider(event)
+
+@pytest.fixture
+def payment(env):
+    client, orga, event, order, payment = env
+    return payment
+
+@pytest.fixture
+def scb_calls(provider, monkeypatch):
+    """
+        Replace the SCB request. Application keys mapped to an exception in
+        the returned dict fail with it, the others return a QR image.
+    """
+    calls = []
+    errors = {}
+
+    def qrcode_create_biller(self, amount, ppId, ref1, ref2, ref3):
+        calls.append((self.app_key, ppId))
+        if self.app_key in errors:
+            raise errors[self.app_key]
+        return { 'qrImage': 'QR-' + self.app_key }
+
+    monkeypatch.setattr(ScbPartnerApi, 'qrcode_create_biller', qrcode_create_biller)
+    # Fix the order of the sets instead of depending on the round-robin.
+    monkeypatch.setattr(provider, 'select_credential_sets', provider.get_credential_sets)
+    return calls, errors
+
+def test_parse_credential_sets():
+    assert PromptPayScbPaymentProvider.parse_credential_sets('key secret 123\nkey2 secret2 456 3') == [
+        ScbCredentialSet(app_key='key', app_secret='secret', pp_id='123', weight=1),
+        ScbCredentialSet(app_key='key2', app_secret='secret2', pp_id='456', weight=3),
+    ]
+
+@pytest.mark.parametrize('text', ['key secret', 'key secret 123 0', 'key secret 123 x', 'a b c d e'])
+def test_parse_credential_sets_invalid(text):
+    with pytest.raises(ValueError):
+        PromptPayScbPaymentProvider.parse_credential_sets(text)
+
+@pytest.mark.django_db
+def test_biller_ids(provider):
+    assert provider.get_biller_ids() == {'111', '222', '333'}
+
+@pytest.mark.django_db
+def test_weighted_round_robin(provider):
+    picks = [provider.select_credential_sets()[0].app_key for _ in range(40)]
+    assert picks.count('key1') == 10
+    assert picks.count('key2') == 20
+    assert picks.count('key3') == 10
+
+@pytest.mark.django_db
+def test_unhealthy_set_skipped(provider):
+    provider.event.cache.set('scb_unhealthy_key2', True)
+
+    for _ in range(10):
+        assert [c.app_key for c in provider.select_credential_sets()] in (['key1', 'key3'], ['key3', 'key1'])
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('error', [
+    requests.ConnectionError('SCB is down'),
+    requests.Timeout('SCB is overloaded'),
+    ScbPartnerApi.BussinessError(9300, 'Too many requests', http_status=429),
+    ScbPartnerApi.BussinessError(9500, 'Internal error', http_status=500),
+])
+def test_failover(provider, payment, scb_calls, error):
+    calls, errors = scb_calls
+    errors['key1'] = error
+
+    assert provider.create_qr_code(payment) == 'QR-key2'
+    assert calls == [('key1', '111'), ('key2', '222')]
+
+    unhealthy = provider.event.cache.get_many(['scb_unhealthy_key1', 'scb_unhealthy_key2'])
+    assert list(unhealthy) == ['scb_unhealthy_key1']
+
+@pytest.mark.django_db
+def test_all_sets_failing(provider, payment, scb_calls):
+    calls, errors = scb_calls
+    for key in ('key1', 'key2', 'key3'):
+        errors[key] = requests.ConnectionError('SCB is down')
+
+    with pytest.raises(requests.ConnectionError):
+        provider.create_qr_code(payment)
+    assert len(calls) == 3
+
+@pytest.mark.django_db
+def test_request_error_no_failover(provider, payment, scb_calls):
+    calls, errors = scb_calls
+    errors['key1'] = ScbPartnerApi.BussinessError(9100, 'Invalid amount', http_status=400)
+
+    with pytest.raises(ScbPartnerApi.BussinessError):
+        provider.create_qr_code(payment)
+
+    assert calls == [('key1', '111')]
+    assert provider.event.cache.get('scb_unhealthy_key1') is None
+
+@pytest.mark.django_db
+def test_api_timeout(provider, monkeypatch):
+    kwargs_seen = []
+
+    def post(**kwargs):
+        kwargs_seen.append(kwargs)
+        raise requests.Timeout('SCB is overloaded')
+
+    monkeypatch.setattr(requests, 'post', post)
+    api = provider.get_api(provider.get_credential_sets()[0])
+
+    with pytest.raises(requests.Timeout):
+        api.post(url=api.v1_url + '/oauth/token', json={}, skip_authz=True)
+    assert kwargs_seen[0]['timeout'] == SCB_API_TIMEOUT
+
+def post_callback(client, event, order, transaction_id, biller_id):
+    url = eventreverse(
+        obj=event,
+        name='plugins:pretix_promptpay_scb:callback',
+        kwargs={ 'callback_secret': 'secret' }
+    )
+    return client.post(url, data=json.dumps({
+        'transactionId': transaction_id,
+        'billPaymentRef1': 'PROMPTPAY',
+        'billPaymentRef2': order.code,
+        'payeeProxyId': biller_id,
+        'amount': '13.37',
+        'transactionDateandTime': now().isoformat(),
+    }), content_type='application/json')
+
+@pytest.mark.django_db
+def test_callback_extra_biller(client, provider, payment):
+    response = post_callback(client, provider.event, payment.order, 'TRANS0001', '333')
+    assert response.status_code == 200
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+@pytest.mark.django_db
+def test_callback_unknown_biller(client, provider, payment):
+    # e.g. paid to an application removed while its QR code was still out.
+    response = post_callback(client, provider.event, payment.order, 'TRANS0001', '999')
+    assert response.status_code == 200
+
+    assert SCBTransaction.objects.get(transaction_id='TRANS0001').state == SCBTransaction.STATE_MATCHED
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
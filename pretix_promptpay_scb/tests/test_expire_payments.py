@@ -0,0 +1,135 @@
+import datetime
+import json
+
+import pytest
+from django.contrib.messages import get_messages
+from django.utils.timezone import now
+from django_scopes import scope
+
+from pretix.base.models import Order, OrderPayment
+from pretix.multidomain.urlreverse import eventreverse
+
+from pretix_promptpay_scb import tasks
+from pretix_promptpay_scb.signals import expire_payments
+
+@pytest.fixture
+def env(env):
+    client, orga, event, order, payment = env
+    with scope(organizer=orga):
+        event.settings.set('payment_promptpay_scb__enabled', True)
+        event.settings.set('payment_promptpay_scb_callback_secret', 'secret')
+        event.settings.set('payment_promptpay_scb_qr_lifetime', 30)
+
+    return env
+
+def age_payment(payment, minutes):
+    OrderPayment.objects.filter(pk=payment.pk).update(
+        created=now() - datetime.timedelta(minutes=minutes))
+
+@pytest.mark.django_db
+def test_fresh_payment_kept(env):
+    client, orga, event, order, payment = env
+    age_payment(payment, 10)
+
+    expire_payments(sender=None)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+
+@pytest.mark.django_db
+def test_stale_payment_canceled(env):
+    client, orga, event, order, payment = env
+    age_payment(payment, 60)
+
+    expire_payments(sender=None)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CANCELED
+    assert 'qr_image' not in payment.info_data
+
+@pytest.mark.django_db
+def test_batches(env, monkeypatch):
+    client, orga, event, order, payment = env
+    monkeypatch.setattr(tasks, 'EXPIRE_BATCH_SIZE', 1)
+    with scope(organizer=orga):
+        payments = [payment] + [
+            order.payments.create(
+                amount=order.total,
+                provider='promptpay_scb',
+                state=OrderPayment.PAYMENT_STATE_PENDING,
+            )
+            for _ in range(2)
+        ]
+    for p in payments:
+        age_payment(p, 60)
+
+    expire_payments(sender=None)
+
+    for p in payments:
+        p.refresh_from_db()
+        assert p.state == OrderPayment.PAYMENT_STATE_CANCELED
+
+    with scope(organizer=orga):
+        log_entries = order.all_logentries().filter(action_type='pretix.event.order.payment.canceled')
+        assert sorted(e.parsed_data['local_id'] for e in log_entries) == sorted(p.local_id for p in payments)
+
+@pytest.mark.django_db
+def test_show_qr_expired(env):
+    client, orga, event, order, payment = env
+    age_payment(payment, 60)
+    expire_payments(sender=None)
+
+    url = eventreverse(
+        obj=event,
+        name='plugins:pretix_promptpay_scb:show_qr',
+        kwargs={
+            'order': order.code,
+            'payment': payment.pk,
+            'secret': order.secret
+        }
+    )
+    response = client.get(url)
+
+    assert response['Location'] == '/%s/%s/order/%s/%s/' % (
+        orga.slug, event.slug, order.code, order.secret
+    )
+    assert [str(m) for m in get_messages(response.wsgi_request)] == [
+        'QR code หมดอายุแล้ว โปรดชำระเงินใหม่อีกครั้ง'
+    ]
+
+@pytest.mark.django_db
+def test_no_lifetime_configured(env):
+    client, orga, event, order, payment = env
+    with scope(organizer=orga):
+        event.settings.delete('payment_promptpay_scb_qr_lifetime')
+    age_payment(payment, 60 * 24)
+
+    expire_payments(sender=None)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+
+@pytest.mark.django_db
+def test_late_callback_confirms(env):
+    client, orga, event, order, payment = env
+    age_payment(payment, 60)
+    expire_payments(sender=None)
+
+    url = eventreverse(
+        obj=event,
+        name='plugins:pretix_promptpay_scb:callback',
+        kwargs={ 'callback_secret': 'secret' }
+    )
+    response = client.post(url, data=json.dumps({
+        'transactionId': 'LATE0001',
+        'billPaymentRef1': 'PROMPTPAY',
+        'billPaymentRef2': order.code,
+        'amount': '13.37',
+        'transactionDateandTime': now().isoformat(),
+    }), content_type='application/json')
+    assert response.status_code == 200
+
+    order.refresh_from_db()
+    assert order.status == Order.STATUS_PAID
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CANCELED
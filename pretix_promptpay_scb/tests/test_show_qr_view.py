@@ -1,5 +1,4 @@
 import datetime
-import json
 from decimal import Decimal
 
 import pytest
@@ -7,40 +6,9 @@ from django.contrib.messages import get_messages
 from django.utils.timezone import now
 from django_scopes import scope
 
-from pretix.base.models import (
-    Event, Order, OrderPayment, OrderRefund, Organizer, Team, User,
-)
+from pretix.base.models import OrderPayment
 from pretix.multidomain.urlreverse import eventreverse
 
-@pytest.fixture
-def env(client):
-    orga = Organizer.objects.create(name='SCB', slug='SCB')
-    with scope(organizer=orga):
-        event = Event.objects.create(
-            organizer=orga, name='SCB PromptPay QR', slug='promptpay',
-            date_from=datetime.datetime(now().year + 1, 12, 26, tzinfo=datetime.timezone.utc),
-            plugins='pretix_promptpay_scb',
-            live=True
-        )
-        order = Order.objects.create(
-            code='FOOBAR', event=event, email='dummy@dummy.test',
-            status=Order.STATUS_PENDING,
-            datetime=now(), expires=now() + datetime.timedelta(days=10),
-            total=Decimal('13.37'),
-        )
-        payment = order.payments.create(
-            amount=order.total,
-            provider='promptpay_scb',
-            state=OrderPayment.PAYMENT_STATE_PENDING,
-            info=json.dumps({
-                # 1x1 GIF.
-                'qr_image': 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mP8/x8AAwMCAO+ip1sAAAAASUVORK5CYII=',
-            }),
-            # What else?
-        )
-
-    return client, orga, event, order, payment
-
 def get_show_qr_url(event, payment):
     return eventreverse(
         obj=event,
@@ -98,3 +66,69 @@ def test_failed_payment(env):
     assert response['Location'] == '/%s/%s/order/%s/%s/' % (
         orga.slug, event.slug, order.code, order.secret
     )
+
+@pytest.mark.django_db
+def test_pending_qr_code(env):
+    client, orga, event, order, payment = env
+    with scope(organizer=orga):
+        payment.info_data = { 'qr_pending': True }
+        payment.save()
+
+    url = get_show_qr_url(event, payment)
+    response = client.get(url)
+    assert response.status_code == 200 # QR code is loaded later by script
+    assert response.context['qr_data_url'] is None
+
+@pytest.mark.django_db
+def test_stuck_qr_code(env):
+    client, orga, event, order, payment = env
+    with scope(organizer=orga):
+        payment.info_data = { 'qr_pending': True }
+        payment.save()
+    # e.g. no task worker ever picked it up.
+    OrderPayment.objects.filter(pk=payment.pk).update(
+        created=now() - datetime.timedelta(minutes=5))
+
+    url = get_show_qr_url(event, payment)
+    response = client.get(url)
+    assert response.status_code == 302
+    assert [str(m) for m in get_messages(response.wsgi_request)] == [
+        'เกิดข้อผิดพลาดในการสร้าง QR code'
+    ]
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+    assert 'qr_error' in payment.info_data
+
+@pytest.mark.django_db
+def test_missing_qr_code(env):
+    client, orga, event, order, payment = env
+    with scope(organizer=orga):
+        payment.info_data = {}
+        payment.save()
+
+    url = get_show_qr_url(event, payment)
+    response = client.get(url)
+    assert response.status_code == 302
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+
+@pytest.mark.django_db
+def test_payment_state_qr_code(env):
+    client, orga, event, order, payment = env
+
+    url = eventreverse(
+        obj=event,
+        name='plugins:pretix_promptpay_scb:payment_state',
+        kwargs={
+            'order': order.code,
+            'payment': payment.pk,
+            'secret': order.secret
+        }
+    )
+    response = client.get(url)
+    assert response.json() == { 'state': 'pending', 'redirectTo': None }
+
+    response = client.get(url + '?qr=1')
+    assert response.json()['qrDataUrl'].endswith(payment.info_data['qr_image'])
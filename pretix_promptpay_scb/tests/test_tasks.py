@@ -0,0 +1,132 @@
+import pytest
+import requests
+from django.db import transaction
+from django_scopes import scope
+
+from pretix.base.models import OrderPayment
+
+from pretix_promptpay_scb import tasks
+from pretix_promptpay_scb.payment import PromptPayScbPaymentProvider
+
+# 1x1 GIF.
+QR_IMAGE = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mP8/x8AAwMCAO+ip1sAAAAASUVORK5CYII='
+
+@pytest.fixture
+def env(env):
+    client, orga, event, order, payment = env
+    with scope(organizer=orga):
+        event.settings.set('payment_promptpay_scb_qr_create_async', True)
+        payment.info_data = { 'qr_pending': True }
+        payment.save()
+
+    return env
+
+@pytest.fixture
+def scb_calls(monkeypatch):
+    """
+        Replace the SCB request with one returning QR_IMAGE, or raising the
+        first exception put in the returned list.
+    """
+    calls = []
+    errors = []
+
+    def create_qr_code(self, payment):
+        calls.append(payment.pk)
+        if errors:
+            raise errors[0]
+        return QR_IMAGE
+
+    monkeypatch.setattr(PromptPayScbPaymentProvider, 'create_qr_code', create_qr_code)
+    return calls, errors
+
+def run_task(event, payment):
+    tasks.create_qr_code.apply(kwargs={ 'event': event.pk, 'payment': payment.pk })
+
+@pytest.mark.django_db
+def test_qr_code_created(env, scb_calls):
+    client, orga, event, order, payment = env
+
+    run_task(event, payment)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert payment.info_data == { 'qr_image': QR_IMAGE }
+
+@pytest.mark.django_db
+def test_retries_exhausted(env, scb_calls):
+    client, orga, event, order, payment = env
+    calls, errors = scb_calls
+    errors.append(requests.ConnectionError('SCB is down'))
+
+    run_task(event, payment)
+
+    assert len(calls) == tasks.create_qr_code.max_retries + 1
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+    assert 'qr_error' in payment.info_data
+
+@pytest.mark.django_db
+def test_malformed_response(env, scb_calls):
+    client, orga, event, order, payment = env
+    calls, errors = scb_calls
+    errors.append(KeyError('qrImage'))
+
+    run_task(event, payment)
+
+    assert len(calls) == tasks.create_qr_code.max_retries + 1
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+    assert 'qr_error' in payment.info_data
+
+@pytest.mark.django_db
+def test_payment_no_longer_pending(env, scb_calls):
+    client, orga, event, order, payment = env
+    calls, errors = scb_calls
+    with scope(organizer=orga):
+        payment.confirm()
+
+    run_task(event, payment)
+
+    assert calls == [] # SCB is not asked at all
+    payment.refresh_from_db()
+    assert 'qr_image' not in payment.info_data
+
+@pytest.mark.django_db
+def test_payment_confirmed_during_request(env, monkeypatch):
+    client, orga, event, order, payment = env
+
+    def create_qr_code(self, payment):
+        # The callback arrives while we are waiting for SCB.
+        OrderPayment.objects.filter(pk=payment.pk).update(
+            state=OrderPayment.PAYMENT_STATE_CONFIRMED)
+        return QR_IMAGE
+
+    monkeypatch.setattr(PromptPayScbPaymentProvider, 'create_qr_code', create_qr_code)
+
+    run_task(event, payment)
+
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert 'qr_image' not in payment.info_data
+
+@pytest.mark.django_db
+def test_execute_payment_queues_task(env, scb_calls, monkeypatch):
+    client, orga, event, order, payment = env
+    calls, errors = scb_calls
+    queued = []
+    monkeypatch.setattr(transaction, 'on_commit', lambda func: func())
+    monkeypatch.setattr(tasks.create_qr_code, 'apply_async', lambda kwargs: queued.append(kwargs))
+
+    with scope(organizer=orga):
+        payment.state = OrderPayment.PAYMENT_STATE_CREATED
+        payment.info_data = {}
+        payment.save()
+
+        url = payment.payment_provider.execute_payment(None, payment)
+
+    assert url.endswith('/promptpay_scb/show_qr')
+    assert calls == [] # Not created during checkout
+    assert queued == [{ 'event': event.pk, 'payment': payment.pk }]
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_PENDING
+    assert payment.info_data == { 'qr_pending': True }
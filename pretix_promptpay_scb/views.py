@@ -1,4 +1,6 @@
+import datetime
 import json
+import logging
 from decimal import Decimal
 from typing import Union
 
@@ -6,6 +8,7 @@ from django.contrib import messages
 from django.db import transaction, IntegrityError
 from django.http.response import JsonResponse, Http404, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, redirect
+from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
@@ -21,6 +24,20 @@ from pretix.base.services.orders import change_payment_provider
 
 from .models import SCBTransaction
 
+logger = logging.getLogger('pretix_promptpay_scb')
+
+# A QR code still being created after this long is considered lost, e.g.
+# because no task worker picked it up.
+QR_PENDING_TIMEOUT = datetime.timedelta(minutes=2)
+
+def get_qr_data_url(payment: OrderPayment) -> Union[str, None]:
+    qr_image = payment.info_data.get('qr_image')
+    if qr_image is None:
+        return None
+
+    # SCB image is a GIF file.
+    return 'data:image/gif;base64,' + qr_image
+
 class ShowQrView(EventViewMixin, OrderDetailMixin, TemplateView):
     template_name = 'pretix_promptpay_scb/order_pay_show_qr.html'
 
@@ -43,17 +60,21 @@ class ShowQrView(EventViewMixin, OrderDetailMixin, TemplateView):
                 return redirect(self.get_order_url() + '?thanks=yes')
         elif self.payment.state not in (OrderPayment.PAYMENT_STATE_CREATED,
                                         OrderPayment.PAYMENT_STATE_PENDING):
+            if 'qr_error' in self.payment.info_data:
+                messages.error(request, _('เกิดข้อผิดพลาดในการสร้าง QR code'))
+            elif 'qr_expired' in self.payment.info_data:
+                messages.error(request, _('QR code หมดอายุแล้ว โปรดชำระเงินใหม่อีกครั้ง'))
             return redirect(self.get_order_url())
 
-        qr_image = self.payment.info_data['qr_image']
-        if qr_image is None:
+        self.qr_data_url = get_qr_data_url(self.payment)
+        # With qr_create_async, the QR code is loaded by script.js once ready.
+        qr_pending = self.payment.info_data.get('qr_pending') and \
+            self.payment.created > timezone.now() - QR_PENDING_TIMEOUT
+        if self.qr_data_url is None and not qr_pending:
             messages.error(request, _('เกิดข้อผิดพลาดในการสร้าง QR code'))
-            self.payment.fail()
+            self.payment.fail(info={ 'qr_error': 'QR code is not created in time' })
             return redirect(self.get_order_url())
 
-        # SCB image is a GIF file.
-        self.qr_data_url = 'data:image/gif;base64,' + qr_image
-
         return super().dispatch(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
@@ -88,10 +109,15 @@ class PaymentStateView(OrderDetailMixin, View):
             else:
                 redirect_to = self.get_order_url() + '?thanks=yes'
 
-        return JsonResponse({
+        response = {
             'state': state,
             'redirectTo': redirect_to,
-        })
+        }
+        # Only send the (rather large) image to clients still waiting for it.
+        if 'qr' in request.GET:
+            response['qrDataUrl'] = get_qr_data_url(self.payment)
+
+        return JsonResponse(response)
 
 class SCBSuccessResponse(JsonResponse):
     def __init__(self, transaction_id: str):
@@ -191,6 +217,15 @@ def callback_view(request, *args, **kwargs):
         # FIXME: is this a good response?
         return HttpResponseBadRequest()
 
+    # Payments may go to any of the configured applications' billers. Others
+    # may come from an application removed while its QR codes were still out;
+    # the customer has paid nonetheless, so accept them. Older confirmations
+    # may not include the biller at all.
+    if 'payeeProxyId' in confirmation and \
+            confirmation['payeeProxyId'] not in payment_provider.get_biller_ids():
+        logger.warning('Transaction %s is paid to biller %s, which is not configured.',
+                       transaction_id, confirmation['payeeProxyId'])
+
     # Ensure that the order exists
     order: Union[Order, None] = event.orders.get(code=ref2)
     if order is None: